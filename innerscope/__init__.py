@@ -1,14 +1,20 @@
-import importlib.metadata
-
 from .core import bindwith, call, callwith, scoped_function
 
-try:
-    __version__ = importlib.metadata.version("innerscope")
-except Exception as exc:  # pragma: no cover (safety)
-    raise AttributeError(
-        "`innerscope.__version__` not available. This may mean "
-        "innerscope was incorrectly installed or not installed at all. "
-        "For local development, you may want to do an editable install via "
-        "`python -m pip install -e path/to/innerscope`"
-    ) from exc
-del importlib
+
+def __getattr__(name):
+    # Importing `importlib.metadata` is slow, so only do it if `__version__` is used
+    if name != "__version__":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    import importlib.metadata
+
+    try:
+        version = importlib.metadata.version("innerscope")
+    except Exception as exc:  # pragma: no cover (safety)
+        raise AttributeError(
+            "`innerscope.__version__` not available. This may mean "
+            "innerscope was incorrectly installed or not installed at all. "
+            "For local development, you may want to do an editable install via "
+            "`python -m pip install -e path/to/innerscope`"
+        ) from exc
+    globals()["__version__"] = version
+    return version
@@ -1,162 +1,448 @@
 import builtins
+import contextlib
 import dis
 import functools
 import html
-import inspect
+import operator
 import sys
+import threading
 import warnings
 from collections.abc import Mapping
 from types import CellType, CodeType, FunctionType, MethodType
 
-from tlz import concatv, merge
-
 from . import cfg
 
-if sys.version_info < (3, 11):
-    NEW_CODE = (
-        bytes([dis.opmap["LOAD_GLOBAL"]])
-        + b"%b"
-        + bytes([dis.opmap["CALL_FUNCTION"], 0, dis.opmap["LOAD_GLOBAL"]])
-        + b"%b"
-        + bytes([dis.opmap["BUILD_TUPLE"], 3, dis.opmap["RETURN_VALUE"], 0])
-    )
-elif sys.version_info < (3, 12):
-    NEW_CODE = (
-        bytes([dis.opmap["LOAD_GLOBAL"]])
-        + b"%b"
-        + bytes(
-            [
-                dis.opmap["CACHE"],
-                0,
-                dis.opmap["CACHE"],
-                0,
-                dis.opmap["CACHE"],
-                0,
-                dis.opmap["CACHE"],
-                0,
-                dis.opmap["CACHE"],
-                0,
-                dis.opmap["PRECALL"],
-                0,
-                dis.opmap["CACHE"],
-                0,
-                dis.opmap["CALL"],
-                0,
-                dis.opmap["CACHE"],
-                0,
-                dis.opmap["CACHE"],
-                0,
-                dis.opmap["CACHE"],
-                0,
-                dis.opmap["CACHE"],
-                0,
-                dis.opmap["LOAD_GLOBAL"],
-            ]
-        )
-        + b"%b"
-        + bytes(
-            [
-                dis.opmap["CACHE"],
-                0,
-                dis.opmap["CACHE"],
-                0,
-                dis.opmap["CACHE"],
-                0,
-                dis.opmap["CACHE"],
-                0,
-                dis.opmap["CACHE"],
-                0,
-                dis.opmap["BUILD_TUPLE"],
-                3,
-                dis.opmap["RETURN_VALUE"],
-                0,
-            ]
-        )
+
+def _epilogue_template():  # pragma: no cover (never called; only its bytecode is used)
+    return (_innerscope_rv_, _innerscope_locals_(), _innerscope_secret_)  # noqa: F821
+
+
+def _get_new_code():
+    """Get the bytecode that turns the value on the stack into ``(rv, locals(), secret)``.
+
+    Instead of assembling the bytes by hand, which depends on version-specific details
+    such as ``PRECALL`` and inline ``CACHE`` entries, we compile a template and take its
+    bytecode after the first value is loaded.  Also returns the offsets of ``LOAD_GLOBAL``
+    instructions and the index into ``co_names`` that each refers to in the template.
+    """
+    code = _epilogue_template.__code__
+    instructions = [
+        inst for inst in dis.get_instructions(code) if inst.opname not in {"RESUME", "CACHE"}
+    ]
+    # Skip loading `_innerscope_rv_`, which is already on the stack in the rewritten code
+    start = instructions[1].offset
+    load_globals = tuple(
+        (inst.offset - start, code.co_names.index(inst.argval))
+        for inst in instructions[1:]
+        if inst.opname == "LOAD_GLOBAL"
     )
-else:
-    NEW_CODE = b""  # NOT YET SUPPORTED
-BUILTINS = set(dir(builtins))
-
-
-def _get_globals_recursive(func, *, seen=None, isclass=False):
-    """Get all global names used by func and all functions and classes defined within it."""
-    if isclass:
-        global_names = set()
-        local_names = {"__name__"}
-        for inst in dis.get_instructions(func):
-            if inst.opname == "STORE_NAME":
-                local_names.add(inst.argval)
-            elif inst.opname == "LOAD_NAME":
-                if inst.argval not in local_names:
-                    global_names.add(inst.argval)
-            elif inst.opname == "LOAD_GLOBAL":  # pragma: no cover
-                global_names.add(inst.argval)
+    return code.co_code[start:], load_globals, code.co_stacksize
+
+
+NEW_CODE, NEW_CODE_LOAD_GLOBALS, NEW_CODE_STACKSIZE = _get_new_code()
+DELETE_DEREF = dis.opmap["DELETE_DEREF"]
+EXTENDED_ARG = dis.opmap["EXTENDED_ARG"]
+JUMP_FORWARD = dis.opmap["JUMP_FORWARD"]
+LOAD_BUILD_CLASS = dis.opmap["LOAD_BUILD_CLASS"]
+LOAD_CONST = dis.opmap["LOAD_CONST"]
+LOAD_GLOBAL = dis.opmap["LOAD_GLOBAL"]
+LOAD_NAME = dis.opmap["LOAD_NAME"]
+RETURN_VALUE = dis.opmap["RETURN_VALUE"]
+STORE_DEREF = dis.opmap["STORE_DEREF"]
+STORE_NAME = dis.opmap["STORE_NAME"]
+# Since Python 3.11, the low bit of the arg of LOAD_GLOBAL says whether to push NULL
+LOAD_GLOBAL_SHIFT = 1 if sys.version_info >= (3, 11) else 0
+# Instructions that may come before `LOAD_NAME __name__` at the start of a class body
+CLASS_BODY_PREAMBLE = {
+    dis.opmap[opname]
+    for opname in ["CACHE", "COPY_FREE_VARS", "MAKE_CELL", "RESUME"]
+    if opname in dis.opmap
+}
+# Code flags, which we get the same way as `inspect` so we don't need to import it
+CO_FLAGS = {name: flag for flag, name in dis.COMPILER_FLAG_NAMES.items()}
+CO_ASYNC_GENERATOR = CO_FLAGS["ASYNC_GENERATOR"]
+CO_COROUTINE = CO_FLAGS["COROUTINE"]
+CO_GENERATOR = CO_FLAGS["GENERATOR"]
+BUILTINS = frozenset(vars(builtins))
+# The beginning and end of UnboundLocalError messages (Python < 3.11 and >= 3.11)
+UNBOUND_LOCAL_ERRORS = (
+    ("local variable ", " referenced before assignment"),
+    ("cannot access local variable ", " where it is not associated with a value"),
+)
+UNBOUND_LOCAL_MESSAGE = (
+    "{message}.\n\n"
+    "This probably means you assigned to a local variable with the same name as a "
+    "variable in an outer scope that you meant to use.  This is, unfortunately, "
+    "a current limitation of `innerscope`.  Workarounds include:\n"
+    "    - Pass {name} in as an argument to the function.\n"
+    "    - Don't assign to {name}; use a different name for the local variable.\n"
+    "\n"
+    "If it's important to you that this limitation is fixed, then please submit "
+    "an issue (or a pull request!) to:\nhttps://github.com/eriknw/innerscope"
+)
+# Static pieces of the HTML reprs: a collapsible section is START + title + BODY + ... + END
+HTML_DETAILS_START = '<details open>\n <summary style="display:list-item; outline:none;">\n  <tt>'
+HTML_DETAILS_BODY = '</tt>\n </summary> <div style="padding-left:10px;padding-bottom:5px;">'
+HTML_DETAILS_END = "</div>\n</details>\n"
+HTML_TABLE_START = (
+    '  <table style="max-width:100%; border:1px solid #AAAAAA;">'
+    "   <tr><th>Name</th><th>Value</th></tr>   "
+)
+HTML_TABLE_END = f"  </table>\n {HTML_DETAILS_END}"
+HTML_SET_START = (
+    '<div style="padding-left:10px;">'
+    '<table style="max-width:100%; border:1px solid #AAAAAA; margin-top:0px; margin-bottom:8px;">'
+    "<tr>"
+)
+HTML_SET_END = "</tr></table></div>"
+
+
+def _iter_ops(code):
+    """Yield ``(offset, opcode, arg)`` for each instruction in `code`.
+
+    This reads ``co_code`` directly, which is much faster than `dis.get_instructions`.
+    """
+    co_code = code.co_code
+    ext_arg = 0
+    for offset in range(0, len(co_code), 2):
+        op = co_code[offset]
+        if op == EXTENDED_ARG:
+            ext_arg = (ext_arg | co_code[offset + 1]) << 8
+        else:
+            yield offset, op, ext_arg | co_code[offset + 1]
+            ext_arg = 0
+
+
+def _is_class_body(code):
+    for _, op, arg in _iter_ops(code):
+        if op not in CLASS_BODY_PREAMBLE:
+            return op == LOAD_NAME and code.co_names[arg] == "__name__"
+    return False  # pragma: no cover
+
+
+@functools.lru_cache(maxsize=1024)
+def _get_return_offsets(code):
+    return tuple(offset for offset, op, _ in _iter_ops(code) if op == RETURN_VALUE)
+
+
+@functools.lru_cache(maxsize=1024)
+def _get_return_jumps(code):
+    """Change RETURN_VALUE to JUMP_FORWARD so all return statements go to the end.
+
+    This way, even long functions can have multiple return statements as long as
+    they are near the end or near each other.  The advantage of this is that we
+    don't need to change the code size, which would require handling other jumps.
+
+    Returns the new ``co_code`` (the epilogue should be appended to it), the offsets
+    of the return statements followed by the offset of the end, and the number of
+    return statements at the beginning that are too far away to be changed.
+
+    This is cached, because it's needed again to report return statements that are too far.
+    """
+    return_indices = _get_return_offsets(code)
+    if code.co_code[-2] == RETURN_VALUE:
+        # Remove the RETURN_VALUE that should be at the end
+        co_code = code.co_code[:-2]
     else:
-        global_names = {
-            inst.argval for inst in dis.get_instructions(func) if inst.opname == "LOAD_GLOBAL"
-        }
-    if seen is None:
-        seen = set()
+        # Ending without a return, such as with exception handlers after the last return
+        # statement, so the last return statement needs to jump to the end too.
+        # Let's add a value for us to return just in case.
+        co_code = code.co_code + bytes([LOAD_CONST, 0])
+        return_indices += (len(co_code),)
+    num_bad = 0
+    jump_target = len(co_code)
+    target_index = len(return_indices) - 1
+    if len(return_indices) > 1:
+        # Both instructions are two bytes, so we can overwrite in place
+        co_code = bytearray(co_code)
+        for index in range(len(return_indices) - 2, -1, -1):
+            i = return_indices[index]
+            target = jump_target - i - 2
+            while target_index > 0 and target > 255:
+                target_index -= 1
+                jump_target = return_indices[target_index]
+                target = jump_target - i - 2
+            if target_index == 0 or target > 255 or target < 0:
+                num_bad = index + 1
+                break
+            if sys.version_info >= (3, 10):
+                target //= 2  # :crossed_fingers:
+            co_code[i] = JUMP_FORWARD
+            co_code[i + 1] = target
+        co_code = bytes(co_code)
+    return co_code, return_indices, num_bad
+
+
+@functools.lru_cache(maxsize=1024)
+def _get_globals_recursive(code, isclass=False):
+    """Get all global names used by code and all functions and classes defined within it.
+
+    Code objects are immutable, so the result is cached, including for nested code.
+    """
+    co_names = code.co_names
+    if not isclass and not any(type(const) is CodeType for const in code.co_consts):
+        # The common case: no nested functions or classes, so only LOAD_GLOBAL matters
+        if not co_names:
+            return frozenset()
+        return frozenset(
+            co_names[arg >> LOAD_GLOBAL_SHIFT]
+            for _, op, arg in _iter_ops(code)
+            if op == LOAD_GLOBAL
+        )
+    global_names = set()
+    local_names = {"__name__"}
     num_classes = 0
-    for inst in dis.get_instructions(func):
-        if inst.opname == "LOAD_CONST" and type(inst.argval) is CodeType:
-            if num_classes > 0:
-                it = dis.get_instructions(inst.argval)
-                code_inst = next(it)
-                if code_inst.opname == "COPY_FREE_VARS":
-                    code_inst = next(it)
-                if code_inst.opname == "RESUME":
-                    code_inst = next(it)
-                isclass = code_inst.opname == "LOAD_NAME" and code_inst.argval == "__name__"
-                num_classes -= isclass
-            if inst.argval in seen:  # pragma: no cover
-                # I don't know how to get into a recursive cycle, but let's prevent it anyway.
+    # Look at each instruction only once; this is the main cost of creating a ScopedFunction
+    for _, op, arg in _iter_ops(code):
+        if op == LOAD_GLOBAL:
+            global_names.add(co_names[arg >> LOAD_GLOBAL_SHIFT])
+        elif op == LOAD_CONST:
+            const = code.co_consts[arg]
+            if type(const) is not CodeType:
                 continue
-            seen.add(inst.argval)
-            global_names.update(_get_globals_recursive(inst.argval, seen=seen, isclass=isclass))
-        elif inst.opname == "LOAD_BUILD_CLASS":
+            nested_isclass = False
+            if num_classes > 0:
+                nested_isclass = _is_class_body(const)
+                num_classes -= nested_isclass
+            global_names.update(_get_globals_recursive(const, nested_isclass))
+        elif op == LOAD_BUILD_CLASS:
             num_classes += 1
-    return global_names
+        elif isclass:
+            if op == STORE_NAME:
+                local_names.add(co_names[arg])
+            elif op == LOAD_NAME and co_names[arg] not in local_names:
+                global_names.add(co_names[arg])
+    return frozenset(global_names)
+
+
+@functools.lru_cache(maxsize=1024)
+def _get_rewritten_bytecode(code):
+    """Get ``co_code`` and ``co_names`` for `code` to end with `return (rv, locals(), secret)`.
+
+    Only data derived from the contents of `code` is cached.  Code objects that compare
+    equal may still differ in e.g. ``co_filename``, so we can't cache the new code object.
+    """
+    co_code, _, _ = _get_return_jumps(code)
+
+    # Modify to end with `return (rv, locals(), secret)`
+    if sys.version_info >= (3, 12):
+        raise NotImplementedError(
+            'Unable to create bytecode for method="bytecode" in this Python version'
+        )
+    co_names = (*code.co_names, "_innerscope_locals_", "_innerscope_secret_")
+    new_code = bytearray(NEW_CODE)
+    for offset, index in NEW_CODE_LOAD_GLOBALS:
+        # Our names are appended to co_names, whereas `_innerscope_rv_` is first in the template
+        index += len(code.co_names) - 1
+        if sys.version_info >= (3, 11):
+            # The low bit of the arg indicates whether to push NULL before the global
+            new_code[offset + 1] = (index << 1) | (new_code[offset + 1] & 1)
+        else:
+            new_code[offset + 1] = index
+    return co_code + new_code, co_names
+
+
+def _rewrite_code(code):
+    """Rewrite the bytecode of `code` to end with `return (rv, locals(), secret)`."""
+    co_code, co_names = _get_rewritten_bytecode(code)
+    return code.replace(
+        co_code=co_code,
+        co_names=co_names,
+        co_stacksize=max(code.co_stacksize, NEW_CODE_STACKSIZE),
+    )
+
+
+def _get_deref_names(code):
+    """The names indexed by the arg of ``*_DEREF`` instructions in `code`."""
+    if sys.version_info >= (3, 11):
+        # The arg indexes all local variables, where cells that are arguments are only once
+        varnames = code.co_varnames
+        cellvars = tuple(name for name in code.co_cellvars if name not in varnames)
+        return varnames + cellvars + code.co_freevars
+    return code.co_cellvars + code.co_freevars
+
+
+@functools.lru_cache(maxsize=1024)
+def _assigns_cellvars(code, names):
+    """Whether `code` or any code defined within it may assign to cell variables `names`."""
+    deref_names = None
+    for _, op, arg in _iter_ops(code):
+        if op in (STORE_DEREF, DELETE_DEREF):
+            if deref_names is None:
+                deref_names = _get_deref_names(code)
+            if deref_names[arg] in names:
+                return True
+    return any(
+        _assigns_cellvars(const, names) for const in code.co_consts if type(const) is CodeType
+    )
+
+
+def _make_closure(code, outer_scope, prior_closure=None):
+    """Create the closure cells of `code` using the values in `outer_scope`.
+
+    The cells in `prior_closure` are reused if they already hold the same values.  This is
+    only safe if the function doesn't assign to its free variables such as via `nonlocal`,
+    because then the cells would be shared.
+    """
+    freevars = code.co_freevars
+    values = map(outer_scope.get, freevars)
+    if prior_closure is None or _assigns_cellvars(code, freevars):
+        return tuple(map(CellType, values))
+    closure = tuple(
+        cell if cell.cell_contents is value else CellType(value)
+        for cell, value in zip(prior_closure, values)
+    )
+    if all(map(operator.is_, closure, prior_closure)):
+        return prior_closure
+    return closure
+
+
+def _merge(mappings, first=()):
+    """Merge `first` and `mappings` into a new dict; later mappings have precedence."""
+    rv = dict(first)
+    for mapping in mappings:
+        rv.update(mapping)
+    return rv
+
+
+# Per-thread state of `_trace_returns`: the tracer to restore and {frame: (code, info)},
+# keyed by the frame that called the traced code, which is `ScopedFunction._call`
+_traced = threading.local()
 
 
-def _get_repr_table(title, scope, add_break=False):
+# coverage uses sys.settrace, so I don't know how to cover this function
+def _trace_func(frame, event, arg):  # pragma: no cover
+    prev_trace = _traced.prev_trace
+    if prev_trace is not None:
+        prev = prev_trace(frame, event, arg)
+        sys.settrace(_trace_func)
+    else:
+        prev = None
+    if event != "call":
+        return prev
+    # Generators may be interleaved, so check which call this frame belongs to
+    code, info = _traced.returns.get(frame.f_back, (None, None))
+    if frame.f_code is not code:
+        return prev
+
+    def trace_returns(frame, event, arg):
+        if event == "return":
+            info["locals"] = frame.f_locals
+        if prev is not None:
+            prev(frame, event, arg)
+
+    if prev is None:
+        # We only need the "return" event, so don't trace every line
+        frame.f_trace_lines = False
+    frame.f_trace = trace_returns
+    return trace_returns
+
+
+@contextlib.contextmanager
+def _trace_returns(code, caller):
+    """Record the locals of `code` by using `sys.settrace` when it returns to `caller`."""
+    returns = getattr(_traced, "returns", None)
+    if returns is None:
+        returns = _traced.returns = {}
+    if not returns:
+        # Only the outermost active call in this thread installs and restores the tracer
+        _traced.prev_trace = sys.gettrace()
+        sys.settrace(_trace_func)
+    info = {}
+    returns[caller] = code, info
+    try:
+        yield info
+    finally:
+        del returns[caller]
+        if not returns:
+            sys.settrace(_traced.prev_trace)
+            _traced.prev_trace = None
+
+
+@functools.lru_cache(maxsize=None)
+def _get_monitoring_tool_id():
+    """Claim a `sys.monitoring` tool id for innerscope, or return None if unavailable.
+
+    `sys.monitoring` is new in Python 3.12.  Unlike `sys.settrace`, it doesn't replace
+    other tracers such as debuggers and coverage, and only the code we ask about is watched.
+    """
+    monitoring = getattr(sys, "monitoring", None)
+    if monitoring is None:
+        return None
+    reserved = {
+        monitoring.DEBUGGER_ID,
+        monitoring.COVERAGE_ID,
+        monitoring.PROFILER_ID,
+        monitoring.OPTIMIZER_ID,
+    }
+    for tool_id in range(6):
+        if tool_id not in reserved and monitoring.get_tool(tool_id) is None:
+            monitoring.use_tool_id(tool_id, "innerscope")
+            monitoring.register_callback(tool_id, monitoring.events.PY_RETURN, _on_py_return)
+            return tool_id
+    return None  # pragma: no cover
+
+
+# {frame: info} of the frame that called the monitored code, which is `ScopedFunction._call`
+_monitored_returns = {}
+# {code: count} of active `_monitor_returns`, so we know when to stop monitoring code
+_monitored_codes = {}
+_monitoring_lock = threading.Lock()
+
+
+def _on_py_return(code, instruction_offset, retval):
+    frame = sys._getframe(1)
+    # Key by the calling frame, since generators may be interleaved or resumed in other threads
+    info = _monitored_returns.get(frame.f_back)
+    if info is not None:
+        # Copy, because f_locals is a write-through proxy in Python 3.13+
+        info["locals"] = dict(frame.f_locals)
+
+
+@contextlib.contextmanager
+def _monitor_returns(code, tool_id, caller):
+    """Record the locals of `code` by using `sys.monitoring` when it returns to `caller`."""
+    monitoring = sys.monitoring
+    _monitored_returns[caller] = info = {}
+    with _monitoring_lock:
+        count = _monitored_codes.get(code, 0)
+        if count == 0:
+            monitoring.set_local_events(tool_id, code, monitoring.events.PY_RETURN)
+        _monitored_codes[code] = count + 1
+    try:
+        yield info
+    finally:
+        del _monitored_returns[caller]
+        with _monitoring_lock:
+            count = _monitored_codes.pop(code) - 1
+            if count:
+                _monitored_codes[code] = count
+            else:
+                monitoring.set_local_events(tool_id, code, 0)
+
+
+def _get_repr_table(title, scope, add_break=False, keys=None):
     if not scope:
         return f'{"<br>" if add_break else ""}<tt>- {title}: {{}}</tt>'
-    keys = sorted(scope)
-    vals = []
+    if keys is None:
+        keys = sorted(scope)
+    parts = [HTML_DETAILS_START, title, HTML_DETAILS_BODY, HTML_TABLE_START]
     for key in keys:
         val = scope[key]
         if hasattr(val, "_repr_html_"):
-            vals.append(val._repr_html_())
+            val = val._repr_html_()
         else:
-            vals.append(html.escape(repr(val)))
-    contents = "".join(
-        f"   <tr><td><tt>{key}</tt></td><td>{val}</td></td>\n" for key, val in zip(keys, vals)
-    )
-    return (
-        "<details open>\n"
-        ' <summary style="display:list-item; outline:none;">\n'
-        f"  <tt>{title}</tt>\n"
-        " </summary>"
-        ' <div style="padding-left:10px;padding-bottom:5px;">'
-        '  <table style="max-width:100%; border:1px solid #AAAAAA;">'
-        "   <tr><th>Name</th><th>Value</th></tr>"
-        f"   {contents}"
-        "  </table>\n </div>\n</details>\n"
-    )
+            val = html.escape(repr(val))
+        parts.append(f"   <tr><td><tt>{key}</tt></td><td>{val}</td></td>\n")
+    parts.append(HTML_TABLE_END)
+    return "".join(parts)
 
 
 def _get_repr_set(title, names):
     if not names:
         return ""
     contents = "".join(f"<td><tt>{name}</tt></td>" for name in names)
-    contents = (
-        '<div style="padding-left:10px;">'
-        '<table style="max-width:100%; border:1px solid #AAAAAA; '
-        'margin-top:0px; margin-bottom:8px;">'
-        f"<tr>{contents}</tr></table></div>"
-    )
-    return f"<tt>- {title}</tt>{contents}"
+    return f"<tt>- {title}</tt>{HTML_SET_START}{contents}{HTML_SET_END}"
 
 
 class Scope(Mapping):
@@ -165,22 +451,80 @@ class Scope(Mapping):
     This is the return value when a `ScopedFunction` is called.
     """
 
+    __slots__ = (
+        "scoped_function",
+        "outer_scope",
+        "inner_scope",
+        "return_value",
+        "_merged",
+        "_sorted_keys",
+        "__weakref__",
+    )
+
     def __init__(self, scoped_function, outer_scope, return_value, inner_scope):
         self.scoped_function = scoped_function
         self.outer_scope = outer_scope
         self.inner_scope = inner_scope
         self.return_value = return_value
+        self._merged = None
+        self._sorted_keys = None
+
+    def _get_merged(self):
+        # Flat view of both scopes so lookups are a single dict access (inner has precedence).
+        # This is created on first use, so creating a Scope doesn't need to copy anything.
+        if self._merged is None:
+            self._merged = {**self.outer_scope, **self.inner_scope}
+        return self._merged
 
+    # Item access and `in` are the hot paths, so they skip the method call once merged
     def __getitem__(self, key):
-        if key in self.inner_scope:
-            return self.inner_scope[key]
-        return self.outer_scope[key]
+        merged = self._merged
+        if merged is None:
+            merged = self._get_merged()
+        return merged[key]
+
+    def __contains__(self, key):
+        merged = self._merged
+        if merged is None:
+            merged = self._get_merged()
+        return key in merged
 
     def __iter__(self):
-        return concatv(self.outer_scope, self.inner_scope)
+        return iter(self._get_merged())
 
     def __len__(self):
-        return len(self.outer_scope) + len(self.inner_scope)
+        return len(self._get_merged())
+
+    # The Mapping mixins go through `__getitem__` and `__iter__`; use the merged dict instead
+    def get(self, key, default=None):
+        return self._get_merged().get(key, default)
+
+    def keys(self):
+        return self._get_merged().keys()
+
+    def values(self):
+        return self._get_merged().values()
+
+    def items(self):
+        return self._get_merged().items()
+
+    def __eq__(self, other):
+        # `Mapping.__eq__` copies both sides into new dicts; compare the merged dict directly
+        if isinstance(other, Scope):
+            other = other._get_merged()
+        elif not isinstance(other, dict):
+            if not isinstance(other, Mapping):
+                return NotImplemented
+            other = dict(other.items())
+        return self._get_merged() == other
+
+    __hash__ = None
+
+    def _get_sorted_keys(self):
+        # Notebooks may display the same Scope many times, so only sort once
+        if self._sorted_keys is None:
+            self._sorted_keys = (sorted(self.outer_scope), sorted(self.inner_scope))
+        return self._sorted_keys
 
     def bindto(self, func, *, use_closures=None, use_globals=None):
         """Bind the variables of this object to a function.
@@ -316,13 +660,13 @@ class Scope(Mapping):
         if len(inner) < 120:
             inner = f" - inner_scope: {inner}\n"
         else:
-            inner = ", ".join(repr(x) for x in sorted(self.inner_scope))
+            inner = ", ".join(repr(x) for x in self._get_sorted_keys()[1])
             inner = f" - inner_scope.keys(): {{{inner}}}\n"
         outer = repr(self.outer_scope)
         if len(outer) < 120:
             outer = f" - outer_scope: {outer}\n"
         else:
-            outer = ", ".join(repr(x) for x in sorted(self.outer_scope))
+            outer = ", ".join(repr(x) for x in self._get_sorted_keys()[0])
             outer = f" - outer_scope.keys(): {{{outer}}}\n"
         return_value = repr(self.return_value)
         if "\\n" in return_value:
@@ -333,17 +677,15 @@ class Scope(Mapping):
         return f"Scope\n{outer}{inner}{return_value}"
 
     def _repr_html_(self):
-        outer = _get_repr_table("outer_scope", self.outer_scope, add_break=True)
-        inner = _get_repr_table("inner_scope", self.inner_scope, add_break=not self.outer_scope)
+        outer_keys, inner_keys = self._get_sorted_keys()
+        outer = _get_repr_table("outer_scope", self.outer_scope, add_break=True, keys=outer_keys)
+        inner = _get_repr_table(
+            "inner_scope", self.inner_scope, add_break=not self.outer_scope, keys=inner_keys
+        )
         if hasattr(self.return_value, "_repr_html_"):
             return_value = (
-                "<details open>\n"
-                ' <summary style="display:list-item; outline:none;">\n'
-                "  <tt>return_value</tt>\n"
-                " </summary>"
-                ' <div style="padding-left:10px;padding-bottom:5px;">'
-                f"{self.return_value._repr_html_()}"
-                "</div>\n</details>\n"
+                f"{HTML_DETAILS_START}return_value{HTML_DETAILS_BODY}"
+                f"{self.return_value._repr_html_()}{HTML_DETAILS_END}"
             )
         else:
             return_value = html.escape(repr(self.return_value))
@@ -351,13 +693,8 @@ class Scope(Mapping):
                 if return_value.count("\\n") > 10:
                     return_value = return_value.replace("\\n", "<br>")
                     return_value = (
-                        "<details open>\n"
-                        ' <summary style="display:list-item; outline:none;">\n'
-                        "  <tt>return_value</tt>\n"
-                        " </summary>"
-                        ' <div style="padding-left:10px;padding-bottom:5px;">'
-                        f"{return_value}"
-                        "</div>\n</details>\n"
+                        f"{HTML_DETAILS_START}return_value{HTML_DETAILS_BODY}"
+                        f"{return_value}{HTML_DETAILS_END}"
                     )
                 else:
                     return_value = return_value.replace("\\n", "<br>")
@@ -387,6 +724,24 @@ class ScopedFunction:
     2
     """
 
+    # `__dict__` is kept for the attributes copied from the wrapped function
+    __slots__ = (
+        "func",
+        "method",
+        "use_closures",
+        "use_globals",
+        "outer_scope",
+        "inner_names",
+        "builtin_names",
+        "missing",
+        "_code",
+        "_closure",
+        "_globals",
+        "_func_repr",
+        "__dict__",
+        "__weakref__",
+    )
+
     def __init__(self, func, *mappings, use_closures=True, use_globals=True, method="default"):
         self.use_closures = use_closures
         self.use_globals = use_globals
@@ -408,40 +763,50 @@ class ScopedFunction:
         if isinstance(func, ScopedFunction):
             self.func = func.func
             code = func.func.__code__
-            outer_scope = merge(func.outer_scope, *mappings)
+            outer_scope = _merge(mappings, func.outer_scope)
             self._code = func._code
-            global_names = func.missing | func.outer_scope.keys()  # includes globals and closures
-            shadowed_globals = func.builtin_names & outer_scope.keys()
-            global_names |= shadowed_globals  # outer_scope may override builtins
-            global_names -= set(code.co_freevars)  # don't include closures in globals
+            # outer_scope may override builtins
+            shadowed_globals = func.builtin_names.intersection(outer_scope)
+            # func.outer_scope includes globals and closures, but don't include closures here
+            global_names = func.missing.union(func.outer_scope, shadowed_globals).difference(
+                code.co_freevars
+            )
             self.builtin_names = func.builtin_names - shadowed_globals
+            # `func` already has the wrapper attributes (and `__wrapped__`) in its `__dict__`
+            self.__dict__.update(func.__dict__)
+            self.inner_names = func.inner_names
+            self._func_repr = func._func_repr
         else:
             self.func = func
             code = func.__code__
-            outer_scope = merge(mappings)
+            # A ScopedFunction being wrapped was already checked, so only check here
+            flags = code.co_flags
+            if flags & CO_COROUTINE:
+                raise ValueError(
+                    f"{type(self).__name__} does not yet work on coroutine functions.  "
+                    "I'm curious what exactly you're trying to do.  Please share :)"
+                )
+            if flags & CO_ASYNC_GENERATOR:
+                raise ValueError(
+                    f"{type(self).__name__} does not yet work on async generator functions.  "
+                    "I'm curious what exactly you're trying to do.  Please share :)"
+                )
+            outer_scope = _merge(mappings)
             self._code = None
-            global_names = _get_globals_recursive(self.func)
+            global_names = _get_globals_recursive(code)
             self.builtin_names = global_names & BUILTINS
-        functools.update_wrapper(self, self.func)
-        if inspect.iscoroutinefunction(self.func):
-            raise ValueError(
-                f"{type(self).__name__} does not yet work on coroutine functions.  "
-                "I'm curious what exactly you're trying to do.  Please share :)"
-            )
-        if inspect.isasyncgenfunction(self.func):
-            raise ValueError(
-                f"{type(self).__name__} does not yet work on async generator functions.  "
-                "I'm curious what exactly you're trying to do.  Please share :)"
-            )
-
+            self._update_wrapper()
+            self.inner_names = frozenset(code.co_varnames + code.co_cellvars)
+            self._func_repr = None
         # Only keep variables needed by the function (globals and closures)
-        outer_scope = {
-            key: outer_scope[key]
-            for key in concatv(global_names, code.co_freevars)
-            if key in outer_scope
-        }
+        if outer_scope:
+            freevars = code.co_freevars
+            outer_scope = {
+                key: val
+                for key, val in outer_scope.items()
+                if key in global_names or key in freevars
+            }
         self.outer_scope = outer_scope
-        self.inner_names = set(code.co_varnames + code.co_cellvars)
         if code.co_freevars:
             if use_closures:
                 # If this is a closure, move the enclosed variabled to `outer_scope`.
@@ -449,166 +814,129 @@ class ScopedFunction:
                 for name, cell in zip(code.co_freevars, self.func.__closure__):
                     if name not in outer_scope:
                         outer_scope[name] = cell.cell_contents
-            self._closure = tuple(CellType(outer_scope.get(name)) for name in code.co_freevars)
+            prior_closure = func._closure if isinstance(func, ScopedFunction) else None
+            self._closure = _make_closure(code, outer_scope, prior_closure)
         else:
             self._closure = None
-        if use_globals:
+        # Only names not already bound need to be looked up in the function's globals
+        unbound = global_names - outer_scope.keys()
+        builtin_names = self.builtin_names
+        if use_globals and unbound:
+            # Find what is missing in the same pass instead of with more set operations
             func_globals = self.func.__globals__
-            for name in global_names:
-                if name not in outer_scope and name in func_globals:
+            missing = set()
+            for name in unbound:
+                if name in func_globals:
                     outer_scope[name] = func_globals[name]
-        self.missing = global_names - outer_scope.keys() - self.builtin_names
+                elif name not in builtin_names:
+                    missing.add(name)
+        else:
+            missing = unbound - builtin_names
         if not use_closures:
-            self.missing.update(name for name in code.co_freevars if name not in outer_scope)
-        self.builtin_names -= self.outer_scope.keys()
+            missing.update(name for name in code.co_freevars if name not in outer_scope)
+        self.missing = frozenset(missing)
+        if outer_scope:
+            self.builtin_names = builtin_names.difference(outer_scope)
 
         if self._code is None and method == "bytecode":
-            self._create_code()
-
-    def _create_code(self):
-        # Change RETURN_VALUE to JUMP_FORWARD.
-        # This way, even long functions can have multiple return statements as long as
-        # they are near the end or near each other.  The advantage of this is that we
-        # don't need to change the code size, which would require handling other jumps.
-        code = self.func.__code__
-        if code.co_code[-2] == dis.opmap["RETURN_VALUE"]:
-            # Remove the RETURN_VALUE that should be at the end
-            co_code = code.co_code[:-2]
-        else:
-            # Ending without a return, but let's add a value for us to return just in case
-            # assert code.co_code[-2] == dis.opmap["RAISE_VARARGS"]
-            co_code = code.co_code + bytes([dis.opmap["LOAD_CONST"], 0])
-        return_indices = [
-            inst.offset for inst in dis.get_instructions(self.func) if inst.opname == "RETURN_VALUE"
-        ]
-        jump_target = len(co_code)
-        target_index = len(return_indices) - 1
-        if len(return_indices) > 1:
-            chunks = []
-            for i in return_indices[-2::-1]:
-                target = jump_target - i - 2
-                while target_index > 0 and target > 255:
-                    target_index -= 1
-                    jump_target = return_indices[target_index]
-                    target = jump_target - i - 2
-                if target_index == 0 or target > 255 or target < 0:
-                    break
-                co_code, chunk = co_code[:i], co_code[i + 2 :]
-                chunks.append(chunk)
-                if sys.version_info >= (3, 10):
-                    target //= 2  # :crossed_fingers:
-                chunks.append(bytes([dis.opmap["JUMP_FORWARD"], target]))
-            chunks.append(co_code)
-            co_code = b"".join(reversed(chunks))
-
-        # Modify to end with `return (rv, locals(), secret)`
-        co_names = (*code.co_names, "_innerscope_locals_", "_innerscope_secret_")
-        if sys.version_info < (3, 11):
-            new_code = NEW_CODE % (bytes([len(code.co_names)]), bytes([len(code.co_names) + 1]))
-        elif sys.version_info < (3, 12):
-            new_code = NEW_CODE % (
-                bytes([2 * len(code.co_names) + 1]),
-                bytes([2 * len(code.co_names) + 2]),
-            )
-        else:
-            raise NotImplementedError(
-                'Unable to create bytecode for method="bytecode" in this Python version'
-            )
-        co_code = co_code + new_code
+            self._code = _rewrite_code(code)
+        self._globals = self._make_globals()
 
-        # stacksize must be at least 3, because we make a length three tuple
-        self._code = code.replace(
-            co_code=co_code,
-            co_names=co_names,
-            co_stacksize=max(code.co_stacksize, 3),
+    def _update_wrapper(self):
+        # Same as `functools.update_wrapper(self, self.func)`, but without its generic machinery
+        func = self.func
+        self.__module__ = func.__module__
+        self.__name__ = func.__name__
+        self.__qualname__ = func.__qualname__
+        self.__doc__ = func.__doc__
+        self.__annotations__ = func.__annotations__
+        if func.__dict__:
+            self.__dict__.update(func.__dict__)
+        self.__wrapped__ = func
+
+    def _make_globals(self):
+        # Template for the globals of the function; `_make_func` makes a copy for each call.
+        # The secret is a placeholder, so setting it per call doesn't insert a new key.
+        # Should we use builtins, builtins.__dict__, or self.func.__globals__['__builtins__']?
+        return dict(
+            self.outer_scope,
+            __builtins__=builtins,
+            _innerscope_locals_=locals,
+            _innerscope_secret_=None,
         )
 
     def __call__(self, *args, **kwargs):
-        [scope] = self._call(args, kwargs)
-        return scope
+        if self.method == "trace":
+            [scope] = self._call(args, kwargs)
+            return scope
+        # Fast path for the bytecode method: call directly instead of going through a generator
+        if self.missing:
+            self._warn_missing()
+        func, outer_scope, secret = self._make_func()
+        try:
+            results = func(*args, **kwargs)
+        except UnboundLocalError as exc:
+            self._raise_unbound_local(exc)
+            raise
+        try:
+            return_value, inner_scope, expect_secret = results
+        except Exception:
+            expect_secret = None
+        if secret is not expect_secret:
+            self._raise_bad_returns()
+        return self._make_scope(outer_scope, return_value, inner_scope)
+
+    def _warn_missing(self):
+        warnings.warn(
+            f"Undefined variables: {', '.join(repr(name) for name in self.missing)}.\n"
+            "Perhaps use `bind` method to assign values for these names before calling.",
+            stacklevel=3,
+        )
+
+    def _make_func(self, code=None):
+        outer_scope = self._globals.copy()
+        outer_scope["_innerscope_secret_"] = secret = object()
+        func = FunctionType(
+            self._code if code is None else code,
+            outer_scope,
+            argdefs=self.func.__defaults__,
+            closure=self._closure,
+        )
+        func.__kwdefaults__ = self.func.__kwdefaults__
+        return func, outer_scope, secret
+
+    def _make_scope(self, outer_scope, return_value, inner_scope):
+        del outer_scope["__builtins__"]
+        del outer_scope["_innerscope_locals_"]
+        del outer_scope["_innerscope_secret_"]
+        # closures show up in locals, but we want them only in outer_scope
+        for key in self.func.__code__.co_freevars:
+            del inner_scope[key]
+        return Scope(self, outer_scope, return_value, inner_scope)
 
     def _call(self, args, kwargs):
         if self.missing:
-            warnings.warn(
-                f"Undefined variables: {', '.join(repr(name) for name in self.missing)}.\n"
-                "Perhaps use `bind` method to assign values for these names before calling.",
-                stacklevel=2,
-            )
-        # Should we use builtins, builtins.__dict__, or self.func.__globals__['__builtins__']?
-        outer_scope = self.outer_scope.copy()
-        outer_scope["__builtins__"] = builtins
-        outer_scope["_innerscope_locals_"] = locals
-        outer_scope["_innerscope_secret_"] = secret = object()
+            self._warn_missing()
         is_trace = self.method == "trace"
         if is_trace:
-            code = self.func.__code__
-            prev_trace = sys.gettrace()
-            info = {}
-
-            # coverage uses sys.settrace, so I don't know how to cover this function
-            def trace_func(frame, event, arg):  # pragma: no cover
-                if prev_trace is not None:
-                    prev = prev_trace(frame, event, arg)
-                    sys.settrace(trace_func)
-                else:
-                    prev = None
-                if event != "call" or frame.f_code is not func.__code__:
-                    return prev
-
-                def trace_returns(frame, event, arg):
-                    if event == "return":
-                        info["locals"] = frame.f_locals
-                    if prev is not None:
-                        prev(frame, event, arg)
-
-                frame.f_trace = trace_returns
-                return trace_returns
-
+            func, outer_scope, secret = self._make_func(self.func.__code__)
+            tool_id = _get_monitoring_tool_id()
+            if tool_id is None:
+                watch_returns = _trace_returns(func.__code__, sys._getframe())
+            else:
+                watch_returns = _monitor_returns(func.__code__, tool_id, sys._getframe())
         else:
-            code = self._code
+            func, outer_scope, secret = self._make_func()
+            watch_returns = contextlib.nullcontext()
 
-        func = FunctionType(
-            code, outer_scope, argdefs=self.func.__defaults__, closure=self._closure
-        )
-        func.__kwdefaults__ = self.func.__kwdefaults__
         try:
-            if is_trace:
-                sys.settrace(trace_func)
-            return_value = func(*args, **kwargs)
-            if type(self) is ScopedGeneratorFunction:
-                return_value = yield from return_value
+            with watch_returns as info:
+                return_value = func(*args, **kwargs)
+                if type(self) is ScopedGeneratorFunction:
+                    return_value = yield from return_value
         except UnboundLocalError as exc:
-            message = exc.args and exc.args[0] or ""
-            if isinstance(message, str) and (
-                message.startswith("local variable ")
-                and message.endswith(" referenced before assignment")
-                or message.startswith("cannot access local variable")
-                and message.endswith("where it is not associated with a value")
-            ):
-                if message.startswith("local variable "):
-                    name = message[len("local variable ") : -len(" referenced before assignment")]
-                else:
-                    name = message[
-                        len("cannot access local variable ") : -len(
-                            "where it is not associated with a value"
-                        )
-                    ]
-                raise UnboundLocalError(
-                    f"{message}.\n\n"
-                    "This probably means you assigned to a local variable with the same name as a "
-                    "variable in an outer scope that you meant to use.  This is, unfortunately, "
-                    "a current limitation of `innerscope`.  Workarounds include:\n"
-                    f"    - Pass {name} in as an argument to the function.\n"
-                    f"    - Don't assign to {name}; use a different name for the local variable.\n"
-                    "\n"
-                    "If it's important to you that this limitation is fixed, then please submit "
-                    "an issue (or a pull request!) to:\nhttps://github.com/eriknw/innerscope"
-                ) from exc
-            else:
-                raise
-        finally:
-            if is_trace:
-                sys.settrace(prev_trace)
+            self._raise_unbound_local(exc)
+            raise
         if is_trace:
             inner_scope = info["locals"]
         else:
@@ -617,43 +945,32 @@ class ScopedFunction:
             except Exception:
                 expect_secret = None
         if is_trace or secret is expect_secret:
-            del outer_scope["__builtins__"]
-            del outer_scope["_innerscope_locals_"]
-            del outer_scope["_innerscope_secret_"]
-            # closures show up in locals, but we want them only in outer_scope
-            if is_trace:
-                freevars = self.func.__code__.co_freevars
-            else:
-                freevars = self._code.co_freevars
-            for key in freevars:
-                del inner_scope[key]
-            rv = Scope(self, outer_scope, return_value, inner_scope)
+            rv = self._make_scope(outer_scope, return_value, inner_scope)
             if type(self) is ScopedGeneratorFunction:
                 return rv
             else:
                 yield rv
                 return
+        self._raise_bad_returns()
+
+    def _raise_unbound_local(self, exc):
+        message = exc.args and exc.args[0] or ""
+        if not isinstance(message, str):
+            return
+        for prefix, suffix in UNBOUND_LOCAL_ERRORS:
+            if message.startswith(prefix) and message.endswith(suffix):
+                name = message[len(prefix) : -len(suffix)].strip()
+                raise UnboundLocalError(
+                    UNBOUND_LOCAL_MESSAGE.format(message=message, name=name)
+                ) from exc
 
-        return_indices = [
-            inst.offset for inst in dis.get_instructions(self.func) if inst.opname == "RETURN_VALUE"
-        ]
-        jump_target = len(func.__code__.co_code) - 2
-        target_index = len(return_indices) - 1
-        bad_returns = []
-        for i in return_indices[-2::-1]:
-            target = jump_target - i - 2
-            while target_index > 0 and target > 255:
-                target_index -= 1
-                jump_target = return_indices[target_index]
-                target = jump_target - i - 2
-            if target_index == 0 or target > 255 or target < 0:
-                target_index = 0
-                bad_returns.append(i)
-        if len(bad_returns) == 1:
+    def _raise_bad_returns(self):
+        _, return_indices, num_bad = _get_return_jumps(self.func.__code__)
+        if num_bad == 1:
             return_msg = "The first return statement is too far away."
         else:
-            return_msg = f"The first {len(bad_returns)} return statements are too far away."
-        next_closest = return_indices[len(bad_returns)] - bad_returns[0]
+            return_msg = f"The first {num_bad} return statements are too far away."
+        next_closest = return_indices[num_bad] - return_indices[num_bad - 1]
         raise ValueError(
             f"This may sound weird, but functions wrapped by {type(self).__name__} should have "
             "return statements that are close together or near the end of the function.  "
@@ -681,27 +998,33 @@ class ScopedFunction:
         ...     cheezburger = [bun, patty, cheez, bun]
 
         >>> makez_cheezburger.missing
-        {'cheez'}
+        frozenset({'cheez'})
         >>> makez_cheezburger_with_cheddar = makez_cheezburger.bind(cheez='cheddar')
         >>> makez_cheezburger_with_cheddar.missing
-        set()
+        frozenset()
         >>> haz_cheezburger = makez_cheezburger_with_cheddar()
         >>> 'cheddar' in haz_cheezburger['cheezburger']
         True
         """
         return scoped_function(
-            self.func,
-            self.outer_scope,
+            self,
             *mappings,
             kwargs,
             use_closures=self.use_closures,
             use_globals=self.use_globals,
         )
 
+    def _get_func_repr(self):
+        # `inspect.signature` is slow, so only do this once (notebooks may display us often)
+        if self._func_repr is None:
+            import inspect  # only needed here, so don't make `import innerscope` slower
+
+            func = self.func
+            self._func_repr = f"{func.__module__}.{func.__name__}{inspect.signature(func)}"
+        return self._func_repr
+
     def __repr__(self):
-        func = self.func
-        sig = inspect.signature(func)
-        func = f" - func: {func.__module__}.{func.__name__}{sig}\n"
+        func = f" - func: {self._get_func_repr()}\n"
         inner = ", ".join(repr(x) for x in sorted(self.inner_names))
         inner = f" - inner_scope: {{{inner}}}\n"
         outer = repr(self.outer_scope)
@@ -718,10 +1041,7 @@ class ScopedFunction:
         return f"{type(self).__name__}\n{func}{inner}{outer}{missing}"
 
     def _repr_html_(self):
-        func = self.func
-        sig = inspect.signature(func)
-        func = f"{func.__module__}.{func.__name__}{sig}"
-        func = _get_repr_set("func", [func])
+        func = _get_repr_set("func", [self._get_func_repr()])
         inner = _get_repr_set("inner_names", self.inner_names)
         missing = _get_repr_set("missing", self.missing)
         outer = _get_repr_table("outer_scope", self.outer_scope)
@@ -739,22 +1059,41 @@ class ScopedFunction:
 
     def __getstate__(self):
         rv = dict(self.__dict__)
+        for key in ScopedFunction.__slots__:
+            # _globals has the builtins module, which can't be pickled
+            if key not in {"_code", "_globals", "_func_repr", "__dict__", "__weakref__"}:
+                rv[key] = getattr(self, key)
         rv["_code"] = None
         return rv
 
     def __setstate__(self, state):
-        self.__dict__.update(state)
+        for key, val in state.items():
+            setattr(self, key, val)
         if self.method == "bytecode":
-            self._create_code()
+            self._code = _rewrite_code(self.func.__code__)
+        self._globals = self._make_globals()
+        self._func_repr = None
 
 
 class ScopedGeneratorFunction(ScopedFunction):
+    __slots__ = ()
+
     def __call__(self, *args, **kwargs):
         gen = self._call(args, kwargs)
         rv = yield from gen
         return rv
 
 
+def _get_scoped_class(func):
+    if type(func) is FunctionType:
+        if func.__code__.co_flags & CO_GENERATOR:
+            return ScopedGeneratorFunction
+        return ScopedFunction
+    if type(func) is ScopedFunction or type(func) is ScopedGeneratorFunction:
+        return type(func)
+    raise TypeError(f"scoped_function expects a Python function.  Got type: {type(func)}")
+
+
 def scoped_function(func=None, *mappings, use_closures=True, use_globals=True, method="default"):
     """Use to expose the inner scope of a wrapped function after being called.
 
@@ -784,10 +1123,17 @@ def scoped_function(func=None, *mappings, use_closures=True, use_globals=True, m
     >>> scope['b']
     2
     """
+    if isinstance(func, Mapping):
+        # Used as a decorator such as `@scoped_function({"a": 1})`
+        mappings = (func, *mappings)
+        func = None
     if func is None:
+        if not mappings and use_closures is True and use_globals is True and method == "default":
+            # `@scoped_function()` is the same as `@scoped_function`
+            return scoped_function
 
         def inner_scoped_func(func):
-            return scoped_function(
+            return _get_scoped_class(func)(
                 func,
                 *mappings,
                 use_closures=use_closures,
@@ -797,22 +1143,7 @@ def scoped_function(func=None, *mappings, use_closures=True, use_globals=True, m
 
         return inner_scoped_func
 
-    if isinstance(func, Mapping):
-        return scoped_function(
-            None,
-            func,
-            *mappings,
-            use_closures=use_closures,
-            use_globals=use_globals,
-            method=method,
-        )
-    if type(func) is ScopedGeneratorFunction or inspect.isgeneratorfunction(func):
-        klass = ScopedGeneratorFunction
-    elif type(func) is ScopedFunction or inspect.isfunction(func):
-        klass = ScopedFunction
-    else:
-        raise TypeError(f"scoped_function expects a Python function.  Got type: {type(func)}")
-    return klass(
+    return _get_scoped_class(func)(
         func,
         *mappings,
         use_closures=use_closures,
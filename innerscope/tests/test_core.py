@@ -1,4 +1,8 @@
+import dis
 import pickle
+import sys
+import threading
+from types import CodeType, FunctionType
 
 import pytest
 
@@ -126,6 +130,7 @@ def test_scoped_function_decorators():
     assert f1() == {"a": 1}
     assert f2() == {"a": 1}
     assert f3() == {"a": 1, "b": 2}
+    assert scoped_function() is scoped_function
 
 
 def test_bindto_keeps_options():
@@ -364,6 +369,18 @@ def test_difficult_return():
     if cfg.default_method == "bytecode":
         with pytest.raises(ValueError, match="The first 2 return statements are too far away"):
             f3(0)
+        # Distance from the last return that is too far away to the return after it
+        returns = [
+            inst.offset
+            for inst in dis.get_instructions(f3.func)
+            if inst.opname == "RETURN_VALUE"
+        ]
+        next_closest = returns[2] - returns[1]
+        with pytest.raises(ValueError, match="The next closest return") as exc_info:
+            f3(0)
+        assert f"The next closest return statement is {next_closest} bytes away." in str(
+            exc_info.value
+        )
         with pytest.raises(ValueError, match="The first 2 return statements are too far away"):
             f3(1)
     if cfg.default_method == "trace":
@@ -382,6 +399,33 @@ def test_difficult_return():
     # fmt: on
 
 
+def test_return_before_exception_handler():
+    # Since Python 3.10, exception handlers may come after the last return statement
+    @scoped_function
+    def f(x):
+        try:
+            a = 1 / x
+        except ZeroDivisionError:
+            b = 2
+
+    assert f(1) == {"x": 1, "a": 1.0}
+    assert f(0) == {"x": 0, "b": 2}
+    # The cached return offsets must not be changed when the code is rewritten
+    innerscope.core._get_return_jumps.cache_clear()
+    innerscope.core._get_rewritten_bytecode.cache_clear()
+    assert scoped_function(f.func)(0) == {"x": 0, "b": 2}
+
+    @scoped_function
+    def g(x):
+        try:
+            return 1 / x
+        except ZeroDivisionError:
+            return "oops"
+
+    assert g(2).return_value == 0.5
+    assert g(0).return_value == "oops"
+
+
 # @pytest.mark.xfail(reason="Local variable can't yet be the same name as an outer variable")
 # This limitation may actually be okay to live with
 def test_inner_and_outer_variable():
@@ -495,22 +539,34 @@ def test_inner_class():
     assert scope["A"].z == 120
 
 
-def test_bad_method():
+def test_inner_class_with_super():
+    def f():
+        class A:
+            x = global_x + 1
+
+            def __init__(self):
+                super().__init__()
+
+    scope = innerscope.call(f)
+    assert scope.keys() == {"A", "global_x"}
+    scoped_f = scoped_function(f, use_globals=False)
+    assert scoped_f.missing == {"global_x"}
+    assert scoped_f.bind(global_x=2)()["A"].x == 3
+
+
+def test_bad_method(monkeypatch):
     def f():
         x = 1
 
     with pytest.raises(ValueError, match="method= argument to ScopedFunc"):
         scoped_function(f, method="bad_method")
-    old_default = cfg.default_method
-    try:
-        cfg.default_method = "bad_method"
+    with monkeypatch.context() as m:
+        m.setattr(cfg, "default_method", "bad_method")
         with pytest.raises(ValueError, match="method= argument to ScopedFunc"):
             scoped_function(f)
-        cfg.default_method = "default"
+        m.setattr(cfg, "default_method", "default")
         with pytest.raises(ValueError, match="silly"):
             scoped_function(f)
-    finally:
-        cfg.default_method = old_default
     assert innerscope.call(f) == {"x": 1}
 
 
@@ -683,3 +739,144 @@ def test_pickle():
     s = pickle.dumps(f)
     f2 = pickle.loads(s)
     assert f2() == dict(a=1, b=2)
+
+
+def test_code_is_cached():
+    def f():
+        a = 1
+
+    sf1 = scoped_function(f)
+    sf2 = scoped_function(f)
+    if cfg.default_method == "bytecode":
+        assert sf1._code == sf2._code
+    assert sf1() == sf2() == {"a": 1}
+    hits = innerscope.core._get_globals_recursive.cache_info().hits
+    bytecode_hits = innerscope.core._get_rewritten_bytecode.cache_info().hits
+    scoped_function(f)
+    assert innerscope.core._get_globals_recursive.cache_info().hits == hits + 1
+    if cfg.default_method == "bytecode":
+        assert innerscope.core._get_rewritten_bytecode.cache_info().hits == bytecode_hits + 1
+
+
+def test_equal_code_different_files():
+    # Code objects compare equal regardless of `co_filename`, such as re-run notebook cells
+    funcs = []
+    for filename in ["cell_1.py", "cell_2.py"]:
+        module_code = compile("def f(x):\n    y = 1 / x\n", filename, "exec")
+        [code] = [const for const in module_code.co_consts if isinstance(const, CodeType)]
+        funcs.append(FunctionType(code, {}))
+    assert funcs[0].__code__ == funcs[1].__code__
+    scoped_function(funcs[0])
+    sf = scoped_function(funcs[1])
+    with pytest.raises(ZeroDivisionError) as exc_info:
+        sf(0)
+    assert exc_info.traceback[-1].frame.code.raw.co_filename == "cell_2.py"
+
+
+def test_scope_overlapping_names():
+    scope = innerscope.core.Scope(None, {"x": 1, "y": 2}, None, {"x": 10, "z": 3})
+    assert scope["x"] == 10
+    assert len(scope) == 3
+    assert list(scope) == ["x", "y", "z"]
+    assert scope == {"x": 10, "y": 2, "z": 3}
+    assert "y" in scope
+    assert "w" not in scope
+    assert scope.get("x") == 10
+    assert scope.get("w", 0) == 0
+    assert scope.keys() == {"x", "y", "z"}
+    assert list(scope.values()) == [10, 2, 3]
+    assert dict(scope.items()) == {"x": 10, "y": 2, "z": 3}
+    assert scope == innerscope.core.Scope(None, {"x": 10, "y": 2}, None, {"z": 3})
+    assert scope != {"x": 1, "y": 2, "z": 3}
+    assert scope != [("x", 10), ("y", 2), ("z", 3)]
+
+
+def test_bind_reuses_closure():
+    a = 1
+    b = 2
+
+    def f():
+        c = a + b + global_x
+
+    sf = scoped_function(f)
+    assert sf.bind(global_x=10)._closure is sf._closure
+    sf2 = sf.bind(a=10)
+    assert sf2._closure is not sf._closure
+    ia, ib = f.__code__.co_freevars.index("a"), f.__code__.co_freevars.index("b")
+    assert sf2._closure[ia] is not sf._closure[ia]
+    assert sf2._closure[ib] is sf._closure[ib]
+    assert sf.bind(global_x=10)() == {"a": 1, "b": 2, "global_x": 10, "c": 13}
+
+    def g():
+        nonlocal a
+        a += 1
+
+    sg = scoped_function(g)
+    sg2 = sg.bind(global_x=10)
+    assert sg2._closure is not sg._closure
+    sg2()
+    assert sg2._closure[0].cell_contents == 2
+    assert sg._closure[0].cell_contents == 1
+
+
+def test_nested_calls():
+    def f(n, sf=None):
+        if sf is not None:
+            inner = sf(n + 1)
+        x = n
+
+    sf = scoped_function(f)
+    scope = sf(1, sf)
+    assert scope["x"] == 1
+    assert scope["inner"]["x"] == 2
+    assert "inner" not in scope["inner"]
+
+
+def test_interleaved_generators():
+    def f(n):
+        x = n
+        yield n
+        y = n + 1
+
+    sf = scoped_function(f)
+    a = sf(1)
+    b = sf(2)
+    assert next(a) == 1
+    assert next(b) == 2
+    with pytest.raises(StopIteration) as exc_a:
+        next(a)
+    with pytest.raises(StopIteration) as exc_b:
+        next(b)
+    assert exc_a.value.value == {"n": 1, "x": 1, "y": 2}
+    assert exc_b.value.value == {"n": 2, "x": 2, "y": 3}
+
+
+def test_trace_keeps_tracer():
+    def f():
+        tracer = sys.gettrace()
+
+    prev = sys.gettrace()
+    scope = scoped_function(f, method="trace")()
+    if sys.version_info >= (3, 12):
+        # sys.monitoring is used instead of sys.settrace
+        assert scope["tracer"] is prev
+    assert sys.gettrace() is prev
+
+
+def test_trace_threads():
+    def f(n):
+        x = n
+
+    sf = scoped_function(f, method="trace")
+    results = {}
+
+    def run(n):
+        for _ in range(100):
+            results[n] = sf(n)["x"] == n and results.get(n, True)
+
+    threads = [threading.Thread(target=run, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == {0: True, 1: True, 2: True, 3: True}